@@ -20,14 +20,15 @@
 
 import sys
 import os
+import atexit
+import re
 import shutil
 import subprocess
+import collections
 from functools import partial
 import PyQt5.QtWidgets as QtWidgets
 import PyQt5.QtCore as QtCore
 import PyQt5.QtGui as QtGui
-import PyQt5.QtMultimedia as QtMultimedia
-import PyQt5.QtMultimediaWidgets as QtMultimediaWidgets
 
 
 def _error(msg):
@@ -35,6 +36,62 @@ def _error(msg):
     sys.exit(1)
 
 
+_FFMPEG_TIME_RE = re.compile(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)')
+_GifParams = collections.namedtuple('_GifParams', ['start', 'duration', 'fps',
+                                                   'width', 'colors', 'lossy'])
+
+
+_VAAPI_DEVICE = '/dev/dri/renderD128'
+
+
+def _vaapi_available():
+    if not os.path.exists(_VAAPI_DEVICE):
+        return False
+
+    try:
+        res = subprocess.run(['ffmpeg', '-hide_banner', '-hwaccels'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             universal_newlines=True)
+    except OSError:
+        return False
+
+    return res.returncode == 0 and 'vaapi' in res.stdout.split()
+
+
+def _gifsicle_supports_lossy():
+    # `--lossy` is available since gifsicle 1.82
+    try:
+        res = subprocess.run(['gifsicle', '--help'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             universal_newlines=True)
+    except OSError:
+        return False
+
+    return '--lossy' in res.stdout
+
+
+# the capture, of which the size is unbounded, always stays on disk
+_DISK_TMP_DIR = '/tmp/mononcgif-tmp'
+
+# minimal free space (bytes) of /dev/shm to use it as the temporary
+# directory of the other intermediate files
+_MIN_SHM_FREE = 1024 * 1024 * 1024
+
+
+def _get_tmp_dir():
+    # /dev/shm is a tmpfs on Linux: keep the intermediate files in RAM
+    # when there's enough room for them
+    try:
+        if shutil.disk_usage('/dev/shm').free >= _MIN_SHM_FREE:
+            return '/dev/shm/mononcgif-tmp'
+    except OSError:
+        pass
+
+    return _DISK_TMP_DIR
+
+
 def _get_screen_geometries():
     desktop = QtWidgets.QApplication.desktop()
     screen_geos = []
@@ -47,12 +104,12 @@ def _get_screen_geometries():
 
 class _CenterableWindow:
     def _center(self):
-        desktop = QtWidgets.QApplication.desktop()
-        geo = desktop.screenGeometry(desktop.primaryScreen())
-        self.show()
-        self.hide()
-        self.move(geo.x() + geo.width() / 2 - (self.width() / 2),
-                  geo.y() + geo.height() / 2 - (self.height() / 2))
+        # let the layout compute my size instead of mapping the window
+        self.layout().activate()
+        self.resize(self.size().expandedTo(self.minimumSizeHint()))
+        geo = QtWidgets.QApplication.primaryScreen().availableGeometry()
+        self.move(geo.x() + (geo.width() - self.width()) // 2,
+                  geo.y() + (geo.height() - self.height()) // 2)
 
 
 class _QSelectRegionWindow(QtWidgets.QWidget):
@@ -125,10 +182,9 @@ class _QSelectRegionWindow(QtWidgets.QWidget):
 
 
 class _QSelectScreenWindow(QtWidgets.QWidget, _CenterableWindow):
-    def __init__(self, screen_geo_selected_func):
+    def __init__(self, screen_geos, screen_geo_selected_func):
         super().__init__()
         self._screen_geo_selected_func = screen_geo_selected_func
-        screen_geos = _get_screen_geometries()
 
         if len(screen_geos) == 1:
             screen_geo_selected_func(screen_geos[0])
@@ -136,17 +192,17 @@ class _QSelectScreenWindow(QtWidgets.QWidget, _CenterableWindow):
             return
 
         self.setWindowTitle('Select screen')
-        self._init_ui()
+        self._init_ui(screen_geos)
         self._show_move()
 
-    def _init_ui(self):
+    def _init_ui(self, screen_geos):
         vlayout = QtWidgets.QVBoxLayout()
         label = QtWidgets.QLabel('Select screen:')
         label.setStyleSheet('font-weight: bold;')
         vlayout.addWidget(label)
         hlayout = QtWidgets.QHBoxLayout()
 
-        for screen_geo in _get_screen_geometries():
+        for screen_geo in screen_geos:
             text = '{}x{}'.format(screen_geo.width(),
                                   screen_geo.height())
             button = QtWidgets.QPushButton(text)
@@ -167,27 +223,86 @@ class _QSelectScreenWindow(QtWidgets.QWidget, _CenterableWindow):
         self._screen_geo_selected_func(screen_geo)
 
 
+class _QRecordingWindow(QtWidgets.QWidget, _CenterableWindow):
+    def __init__(self, capture_rect, stop_func):
+        super().__init__()
+        self._stop_func = stop_func
+        self.setWindowTitle('Recording')
+        self._init_ui()
+        self._show_move(capture_rect)
+
+    def _init_ui(self):
+        vlayout = QtWidgets.QVBoxLayout()
+        label = QtWidgets.QLabel('Recording...')
+        label.setStyleSheet('font-weight: bold;')
+        vlayout.addWidget(label)
+        button = QtWidgets.QPushButton('Stop')
+        button.setDefault(True)
+        button.clicked.connect(self._stop_button_clicked)
+        vlayout.addWidget(button)
+        self.setLayout(vlayout)
+        self.layout().setSizeConstraint(QtWidgets.QLayout.SetFixedSize)
+
+    def _show_move(self, capture_rect):
+        self._center()
+
+        if self.frameGeometry().intersects(capture_rect):
+            # stay out of the captured region if possible
+            geo = QtWidgets.QApplication.primaryScreen().availableGeometry()
+            size = self.frameGeometry().size()
+            corners = [
+                geo.topLeft(),
+                QtCore.QPoint(geo.right() - size.width(), geo.top()),
+                QtCore.QPoint(geo.left(), geo.bottom() - size.height()),
+                QtCore.QPoint(geo.right() - size.width(),
+                              geo.bottom() - size.height()),
+            ]
+
+            for corner in corners:
+                if not QtCore.QRect(corner, size).intersects(capture_rect):
+                    self.move(corner)
+                    break
+
+        self.show()
+
+    def _stop_button_clicked(self):
+        self.close()
+        self._stop_func()
+
+
 class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
-    def __init__(self, video_path, create_func):
+    def __init__(self, create_func):
         super().__init__()
         self._create_func = create_func
+        self._start = 0
+        self._end = 0
+        self._movie = None
+        self._has_video = False
+        self._busy = False
+        self._gif_ints = {}
         self.setWindowTitle('Create GIF')
-        self._init_multimedia(video_path)
+        self._init_multimedia()
         self._init_ui()
         self._show_move()
 
-    def _init_multimedia(self, video_path):
+    def _init_multimedia(self):
+        # imported here because loading the multimedia modules (and their
+        # backend plugins) is slow and only this window needs them
+        import PyQt5.QtMultimedia as QtMultimedia
+        import PyQt5.QtMultimediaWidgets as QtMultimediaWidgets
+
         self._player = QtMultimedia.QMediaPlayer()
         self._w_video = QtMultimediaWidgets.QVideoWidget()
         self._player.setVideoOutput(self._w_video)
         self._playlist = QtMultimedia.QMediaPlaylist()
-        url = QtCore.QUrl.fromLocalFile(video_path)
-        self._playlist.addMedia(QtMultimedia.QMediaContent(url))
-        self._playlist.setCurrentIndex(0)
         self._playlist.setPlaybackMode(QtMultimedia.QMediaPlaylist.CurrentItemInLoop)
-        self._player.setPlaylist(self._playlist)
-        self._player.pause()
-        self._player.durationChanged.connect(self._duration_changed)
+
+        # coalesce the seeks requested while a slider is being dragged
+        self._pending_seek = None
+        self._seek_timer = QtCore.QTimer()
+        self._seek_timer.setSingleShot(True)
+        self._seek_timer.setInterval(80)
+        self._seek_timer.timeout.connect(self._do_seek)
 
     def _init_ui(self):
         main_hlayout = QtWidgets.QHBoxLayout()
@@ -228,11 +343,20 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
         layout.addWidget(self._gif_colors_edit)
         layout.addStretch()
         video_vlayout.addLayout(layout)
+        layout = QtWidgets.QHBoxLayout()
+        self._gif_lossy_edit = QtWidgets.QLineEdit('80')
+        self._gif_lossy_edit.setPlaceholderText('Lossy')
+        self._gif_lossy_edit.setToolTip('Lossy')
+        layout.addWidget(self._gif_lossy_edit)
+        layout.addStretch()
+        video_vlayout.addLayout(layout)
         video_vlayout.addStretch()
         self._create_button = QtWidgets.QPushButton('Create')
         self._create_button.setDefault(True)
+        self._progress_bar = QtWidgets.QProgressBar()
+        self._progress_bar.setRange(0, 100)
         layout = QtWidgets.QHBoxLayout()
-        layout.addStretch()
+        layout.addWidget(self._progress_bar)
         layout.addWidget(self._create_button)
         video_vlayout.addLayout(layout)
         main_hlayout.addLayout(video_vlayout)
@@ -260,6 +384,27 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
         self._slider_start.valueChanged.connect(self._slider_start_value_changed)
         self._slider_end.valueChanged.connect(self._slider_end_value_changed)
 
+        # validate the GIF parameters as they're typed
+        int_edits = [
+            ('width', self._gif_width_edit, 1, 8192),
+            ('frame_rate', self._gif_frame_rate_edit, 1, 120),
+            ('colors', self._gif_colors_edit, 2, 256),
+            ('lossy', self._gif_lossy_edit, 0, 200),
+        ]
+
+        # the C locale without group separators makes any acceptable
+        # input parsable with int()
+        locale = QtCore.QLocale.c()
+        locale.setNumberOptions(QtCore.QLocale.RejectGroupSeparator)
+
+        for name, edit, minimum, maximum in int_edits:
+            validator = QtGui.QIntValidator(minimum, maximum, self)
+            validator.setLocale(locale)
+            edit.setValidator(validator)
+            edit.textChanged.connect(partial(self._gif_int_edit_text_changed,
+                                             name, edit))
+            self._gif_int_edit_text_changed(name, edit, edit.text())
+
     def _show_move(self):
         self.resize(600, 400)
         self._center()
@@ -268,6 +413,7 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
     def _create_slider(self):
         slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
         slider.setMinimum(0)
+        slider.setMaximum(0)
         slider.setSingleStep(100)
         slider.setPageStep(1000)
         return slider
@@ -280,18 +426,32 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
         self._slider_end.setMaximum(duration)
         self._slider_end.setValue(self._end)
         self._update_range_label()
+
+        # cancel the seek to the end requested by setting the end slider
+        self._seek_timer.stop()
         self._player.setPosition(0)
         self._player.pause()
         video_width = self._player.metaData('Resolution').width()
         self._gif_width_edit.setText(str(video_width))
         self._player.durationChanged.disconnect()
 
+        # the range is only known from now on
+        self._has_video = True
+        self._update_create_button()
+
     def _update_range_label(self):
         self._range_label.setText('[{:.3f}, {:.3f}] s'.format(self._start / 1000,
                                                               self._end / 1000))
 
+    def _seek(self, position):
+        self._pending_seek = position
+        self._seek_timer.start()
+
+    def _do_seek(self):
+        self._player.setPosition(self._pending_seek)
+
     def _slider_start_value_changed(self, value):
-        self._player.setPosition(value)
+        self._seek(value)
         self._start = value
 
         if value > self._end:
@@ -301,9 +461,10 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
             self._slider_end.blockSignals(False)
 
         self._update_range_label()
+        self._update_create_button()
 
     def _slider_end_value_changed(self, value):
-        self._player.setPosition(value)
+        self._seek(value)
         self._end = value
 
         if value < self._start:
@@ -313,14 +474,60 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
             self._slider_start.blockSignals(False)
 
         self._update_range_label()
+        self._update_create_button()
+
+    def _gif_int_edit_text_changed(self, name, edit, text):
+        if edit.hasAcceptableInput():
+            self._gif_ints[name] = int(text)
+        else:
+            self._gif_ints[name] = None
+
+        self._update_create_button()
+
+    def _update_create_button(self):
+        valid = (None not in self._gif_ints.values() and
+                 self._end > self._start)
+        self._create_button.setEnabled(self._has_video and not self._busy and
+                                       valid)
 
     def _create_button_clicked(self):
         self._create_func()
 
+    def set_video(self, path):
+        import PyQt5.QtMultimedia as QtMultimedia
+
+        url = QtCore.QUrl.fromLocalFile(path)
+        self._playlist.addMedia(QtMultimedia.QMediaContent(url))
+        self._playlist.setCurrentIndex(0)
+        self._player.durationChanged.connect(self._duration_changed)
+        self._player.setPlaylist(self._playlist)
+        self._player.pause()
+
+    def set_progress(self, progress):
+        # a negative progress means it's unknown: show a busy indicator
+        if progress < 0:
+            self._progress_bar.setRange(0, 0)
+        else:
+            self._progress_bar.setRange(0, 100)
+            self._progress_bar.setValue(progress)
+
+    def set_busy(self, busy):
+        self._busy = busy
+        self._update_create_button()
+
     def set_gif_preview(self, path):
-        movie = QtGui.QMovie(path)
         self._gif_preview_label.setMovie(None)
+
+        if self._movie is not None:
+            self._movie.stop()
+            self._movie.deleteLater()
+
+        movie = QtGui.QMovie(path)
+
+        # decode each frame once instead of on each loop
+        movie.setCacheMode(QtGui.QMovie.CacheAll)
         self._gif_preview_label.setMovie(movie)
+        self._movie = movie
         movie.start()
         size_text = '{:.3f} MiB'.format(os.stat(path).st_size / 1024 / 1024)
         self._gif_file_size_label.setText(size_text)
@@ -335,31 +542,57 @@ class _QCreateGifWindow(QtWidgets.QWidget, _CenterableWindow):
 
     @property
     def gif_width(self):
-        return int(self._gif_width_edit.text())
+        return self._gif_ints['width']
 
     @property
     def gif_frame_rate(self):
-        return int(self._gif_frame_rate_edit.text())
+        return self._gif_ints['frame_rate']
 
     @property
     def gif_colors(self):
-        return int(self._gif_colors_edit.text())
+        return self._gif_ints['colors']
+
+    @property
+    def gif_lossy(self):
+        return self._gif_ints['lossy']
 
 
-class _App:
-    _TMP_DIR = '/tmp/mononcgif-tmp'
-    _CAPTURE_PATH = os.path.join(_TMP_DIR, 'out.ogv')
-    _CAPTURE_MP4_PATH = os.path.join(_TMP_DIR, 'out.mp4')
-    _PALETTE_PATH = os.path.join(_TMP_DIR, 'palette.png')
-    _GIF_PATH = os.path.join(_TMP_DIR, 'out.gif')
-    _OPTI_GIF_PATH = os.path.join(_TMP_DIR, 'out-opti.gif')
+class _App(QtCore.QObject):
+    # minimal range duration (seconds) to encode chunks in parallel
+    _PARALLEL_MIN_TIME = 10
+
+    # clips shorter than this duration (seconds) or with fewer frames
+    # get a palette built from their first frame only
+    _SHORT_CLIP_TIME = 2
+    _SHORT_CLIP_FRAMES = 20
+
+    progress_changed = QtCore.pyqtSignal(int)
 
     def __init__(self, app):
+        super().__init__()
         self._app = app
         self._user_gif_path = sys.argv[1]
+        self._screen_geos = _get_screen_geometries()
+        self._tmp_dir = _get_tmp_dir()
+        self._capture_path = os.path.join(_DISK_TMP_DIR, 'out.mkv')
+        self._palette_path = os.path.join(self._tmp_dir, 'palette.png')
+        self._gif_path = os.path.join(self._tmp_dir, 'out.gif')
+        self._chunk_gif_path = os.path.join(self._tmp_dir, 'chunk-{}.gif')
+        self._use_vaapi = None
+        self._gifsicle_lossy = None
+        self._procs = []
+        self._proc_progress = {}
+        self._progress_total = 0
+        self._palette_key = None
+        self._gif_key = None
+        self._raw_gif_paths = None
+
+        # also covers the _error() paths, which skip `aboutToQuit`
+        atexit.register(self._remove_tmp_dirs)
 
     def run(self):
-        self._select_screen_window = _QSelectScreenWindow(self._screen_geo_clicked)
+        self._select_screen_window = _QSelectScreenWindow(self._screen_geos,
+                                                          self._screen_geo_clicked)
 
     def _screen_geo_clicked(self, screen_geo):
         self._capture_window = _QSelectRegionWindow(screen_geo,
@@ -370,81 +603,416 @@ class _App:
         y = init_pos.y()
         width = cur_pos.x() - init_pos.x()
         height = cur_pos.y() - init_pos.y()
+
+        # 4:2:0 chroma subsampling requires even dimensions
+        width -= width % 2
+        height -= height % 2
         self._capture_video(x, y, width, height)
-        self._create_gif_window = _QCreateGifWindow(self._CAPTURE_PATH,
-                                                    self._create_gif)
+        self._recording_window = _QRecordingWindow(QtCore.QRect(x, y, width,
+                                                                height),
+                                                   self._stop_clicked)
 
-    def _capture_video(self, x, y, width, height):
-        os.makedirs(self._TMP_DIR, exist_ok=True)
-        res = subprocess.run([
-            'recordmydesktop',
-            '-x', str(x),
-            '-y', str(y),
-            '--width', str(width),
-            '--height', str(height),
-            '--no-cursor',
-            '--no-sound',
-            '--overwrite',
-            '-o', self._CAPTURE_PATH,
-        ])
-
-        if res.returncode != 0:
-            _error('recordmydesktop returned {}'.format(res.returncode))
+    def _stop_clicked(self):
+        # `q` makes ffmpeg stop and finalize the file cleanly
+        self._capture_proc.write(b'q')
+        self._capture_proc.closeWriteChannel()
 
-    def _create_gif(self):
-        total_time = self._create_gif_window.end - self._create_gif_window.start
-        fps = self._create_gif_window.gif_frame_rate
-        width = self._create_gif_window.gif_width
-        res = subprocess.run([
-            'ffmpeg',
-            '-y',
-            '-i', self._CAPTURE_PATH,
-            self._CAPTURE_MP4_PATH,
-        ])
+        # build the window (and its multimedia pipeline) while ffmpeg
+        # finalizes the capture; the video is set once it's complete
+        self._create_gif_window = _QCreateGifWindow(self._create_gif)
+        self.progress_changed.connect(self._create_gif_window.set_progress)
 
-        if res.returncode != 0:
-            _error('ffmpeg returned {}'.format(res.returncode))
+    def _capture_done(self, ret):
+        if ret != 0:
+            _error('ffmpeg returned {}'.format(ret))
 
-        res = subprocess.run([
+        self._create_gif_window.set_video(self._capture_path)
+
+    def _remove_tmp_dirs(self):
+        shutil.rmtree(_DISK_TMP_DIR, ignore_errors=True)
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _capture_video(self, x, y, width, height):
+        os.makedirs(_DISK_TMP_DIR, exist_ok=True)
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        display = os.environ.get('DISPLAY', ':0.0')
+
+        # near-lossless 4:2:0 H.264 (High profile) is fast to encode,
+        # cheap to seek afterwards, and decodable by VAAPI and by the
+        # multimedia backend (lossless H.264 requires the High 4:4:4
+        # Predictive profile, which they don't support)
+        self._capture_proc = self._run_proc([
             'ffmpeg',
             '-y',
-            '-ss', str(self._create_gif_window.start),
-            '-t', str(total_time),
-            '-i', self._CAPTURE_MP4_PATH,
-            '-vf', 'fps={},scale={}:-1:flags=lanczos,palettegen'.format(fps, width),
-            self._PALETTE_PATH,
-        ])
+            '-f', 'x11grab',
+            '-draw_mouse', '0',
+            '-video_size', '{}x{}'.format(width, height),
+            '-i', '{}+{},{}'.format(display, x, y),
+            '-c:v', 'libx264',
+            '-preset', 'ultrafast',
+            '-pix_fmt', 'yuv420p',
+            '-profile:v', 'high',
+            '-qp', '1',
+            self._capture_path,
+        ], self._capture_done)
+
+    def _create_proc(self, argv, on_done, duration=None):
+        # when `duration` (seconds) is set, the process is an ffmpeg
+        # instance of which to report the progress
+        proc = QtCore.QProcess()
+        proc.setProgram(argv[0])
+        proc.setArguments(argv[1:])
+
+        if duration is None:
+            proc.setProcessChannelMode(QtCore.QProcess.ForwardedChannels)
+        else:
+            self._proc_progress[proc] = 0
+            proc.readyReadStandardError.connect(partial(self._proc_stderr_ready,
+                                                        proc))
+
+        finished = proc.finished[int, QtCore.QProcess.ExitStatus]
+        finished.connect(partial(self._proc_finished, proc, on_done,
+                                 duration))
+        proc.errorOccurred.connect(partial(self._proc_error_occurred,
+                                           argv[0]))
+        self._procs.append(proc)
+        return proc
+
+    def _run_proc(self, argv, on_done, duration=None):
+        proc = self._create_proc(argv, on_done, duration)
+        proc.start()
+        return proc
+
+    def _proc_stderr_ready(self, proc):
+        data = bytes(proc.readAllStandardError()).decode(errors='replace')
+        sys.stderr.write(data)
+        matches = _FFMPEG_TIME_RE.findall(data)
+
+        if not matches:
+            return
+
+        hours, minutes, seconds = matches[-1]
+        self._proc_progress[proc] = (int(hours) * 3600 + int(minutes) * 60 +
+                                     float(seconds))
+        self._emit_progress()
+
+    def _proc_error_occurred(self, program, error):
+        # `finished` is never emitted in this case
+        if error == QtCore.QProcess.FailedToStart:
+            _error('cannot run {}'.format(program))
+
+    def _proc_finished(self, proc, on_done, duration, exit_code, exit_status):
+        self._procs.remove(proc)
+        proc.deleteLater()
+
+        if duration is not None:
+            self._proc_progress[proc] = duration
+            self._emit_progress()
 
-        if res.returncode != 0:
-            _error('ffmpeg returned {}'.format(res.returncode))
+        if exit_status != QtCore.QProcess.NormalExit:
+            exit_code = -1
+
+        on_done(exit_code)
+
+    def _reset_progress(self, total):
+        # `total` is None when the processes to run cannot report their
+        # progress
+        self._proc_progress = {}
+
+        if total is None:
+            self._progress_total = 0
+            self.progress_changed.emit(-1)
+        else:
+            self._progress_total = total
+            self.progress_changed.emit(0)
+
+    def _emit_progress(self):
+        if self._progress_total <= 0:
+            return
+
+        done = sum(self._proc_progress.values())
+        progress = int(100 * done / self._progress_total)
+        self.progress_changed.emit(max(0, min(progress, 100)))
+
+    def _ffmpeg_input_args(self, start, duration):
+        args = [
+            '-ss', str(start),
+            '-t', str(duration),
+        ]
+
+        if self._use_vaapi:
+            args += [
+                '-hwaccel', 'vaapi',
+                '-hwaccel_output_format', 'vaapi',
+                '-vaapi_device', _VAAPI_DEVICE,
+            ]
+
+        return args + ['-i', self._capture_path]
+
+    def _scale_filter(self, fps, width):
+        if self._use_vaapi:
+            return ('fps={},scale_vaapi=w={}:h=-1,'
+                    'hwdownload,format=nv12').format(fps, width)
+
+        return 'fps={},scale={}:-1:flags=lanczos'.format(fps, width)
+
+    def _is_short_clip(self, params):
+        return (params.duration < self._SHORT_CLIP_TIME or
+                params.fps * params.duration < self._SHORT_CLIP_FRAMES)
+
+    def _palettegen_filter(self, params):
+        if self._is_short_clip(params):
+            # a single frame is representative enough, and paletteuse
+            # receives the palette right away instead of at the end
+            return "select='eq(n,0)',palettegen=stats_mode=single"
+
+        return 'palettegen'
+
+    def _palette_mtime(self):
+        try:
+            return os.stat(self._palette_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _pipeline_stages_needed(self):
+        # returns the minimal set of stages to run to create the GIF
+        # described by the current parameters, reusing the palette and
+        # the unoptimized GIF of the previous runs when possible
+        params = self._gif_params
+        end = params.start + params.duration
+        stages = {'optimize'}
+        gif_key = (params.start, end, params.fps, params.width,
+                   self._palette_mtime())
+
+        if gif_key == self._gif_key:
+            return stages
+
+        stages.add('gif')
+
+        if self._palette_key is not None:
+            palette_start, palette_end, fps, width = self._palette_key
+
+            # a palette generated from a wider range is good enough
+            if ((fps, width) == (params.fps, params.width) and
+                    palette_start <= params.start and end <= palette_end):
+                return stages
+
+        stages.add('palette')
+        return stages
+
+    def _gifsicle_input_args(self):
+        # input options: they apply to the input files which follow them
+        return [
+            '--no-extensions',
+            '--no-comments',
+            '--no-names',
+        ]
+
+    def _gifsicle_output_args(self):
+        args = [
+            '-O3',
+            '--colors', str(self._gif_params.colors),
+        ]
 
-        res = subprocess.run([
+        if self._gif_params.lossy > 0:
+            if self._gifsicle_lossy is None:
+                self._gifsicle_lossy = _gifsicle_supports_lossy()
+
+            if self._gifsicle_lossy:
+                args.append('--lossy={}'.format(self._gif_params.lossy))
+
+        return args + ['-o', self._user_gif_path]
+
+    def _optimize_gif(self, paths, on_done):
+        argv = ['gifsicle', '--merge'] + self._gifsicle_input_args()
+        argv += paths + self._gifsicle_output_args()
+        self._run_proc(argv, on_done)
+
+    def _encode_gif(self, params, stages, on_done):
+        if 'palette' in stages and not self._is_short_clip(params):
+            # paletteuse outputs nothing until palettegen has read the
+            # whole range, so ffmpeg's output time stays at zero
+            self._reset_progress(None)
+        else:
+            self._reset_progress(params.duration)
+
+        scale_filter = self._scale_filter(params.fps, params.width)
+        input_args = self._ffmpeg_input_args(params.start, params.duration)
+        rets = {}
+
+        def proc_done(name, ret):
+            rets[name] = ret
+
+            if len(rets) == 2:
+                on_done(rets['ffmpeg'], rets['gifsicle'])
+
+        if 'palette' in stages:
+            # also keep the palette for the next runs
+            palettegen_filter = self._palettegen_filter(params)
+            filter_graph = ('{},split[a][b];[a]{},split[p][q];'
+                            '[b][p]paletteuse[g]').format(scale_filter,
+                                                          palettegen_filter)
+            output_args = ['-map', '[q]', self._palette_path]
+        else:
+            filter_graph = '{}[x];[x][1:v]paletteuse[g]'.format(scale_filter)
+            input_args += ['-i', self._palette_path]
+            output_args = []
+
+        # the tee muxer writes the unoptimized GIF both to the cache and
+        # to gifsicle
+        ffmpeg = self._create_proc([
             'ffmpeg',
             '-y',
-            '-ss', str(self._create_gif_window.start),
-            '-t', str(total_time),
-            '-i', self._CAPTURE_MP4_PATH,
-            '-i', self._PALETTE_PATH,
-            '-filter_complex', 'fps={},scale={}:-1:flags=lanczos[x];[x][1:v]paletteuse'.format(fps, width),
-            self._GIF_PATH,
-        ])
-
-        if res.returncode != 0:
-            _error('ffmpeg returned {}'.format(res.returncode))
-
-        res = subprocess.run([
-            'gifsicle',
-            '-O3',
-            '--colors', str(self._create_gif_window.gif_colors),
-            self._GIF_PATH,
-            '-o', self._OPTI_GIF_PATH,
-        ])
+        ] + input_args + [
+            '-filter_complex', filter_graph,
+        ] + output_args + [
+            '-map', '[g]',
+            '-c:v', 'gif',
+            '-f', 'tee',
+            '[f=gif]{}|[f=gif]pipe:1'.format(self._gif_path),
+        ], partial(proc_done, 'ffmpeg'), params.duration)
+        gifsicle = self._create_proc(['gifsicle'] +
+                                     self._gifsicle_input_args() +
+                                     self._gifsicle_output_args(),
+                                     partial(proc_done, 'gifsicle'))
+        ffmpeg.setStandardOutputProcess(gifsicle)
+        ffmpeg.start()
+        gifsicle.start()
+
+    def _gen_palette(self, params, on_done):
+        self._run_proc([
+            'ffmpeg',
+            '-y',
+        ] + self._ffmpeg_input_args(params.start, params.duration) + [
+            '-vf', '{},{}'.format(self._scale_filter(params.fps, params.width),
+                                  self._palettegen_filter(params)),
+            self._palette_path,
+        ], on_done, params.duration)
+
+    def _use_palette(self, start, duration, fps, width, path, on_done):
+        filter_graph = '{}[x];[x][1:v]paletteuse'.format(
+            self._scale_filter(fps, width))
+        self._run_proc([
+            'ffmpeg',
+            '-y',
+        ] + self._ffmpeg_input_args(start, duration) + [
+            '-i', self._palette_path,
+            '-filter_complex', filter_graph,
+            path,
+        ], on_done, duration)
+
+    def _parallel_paletteuse(self, start, end, fps, width, paths, on_done):
+        chunk_time = (end - start) / len(paths)
+        rets = []
+
+        def chunk_done(ret):
+            rets.append(ret)
+
+            if len(rets) == len(paths):
+                on_done(next((ret for ret in rets if ret != 0), 0))
+
+        for index, path in enumerate(paths):
+            self._use_palette(start + index * chunk_time, chunk_time, fps,
+                              width, path, chunk_done)
+
+    def _encode_gif_parallel(self, params, stages, on_done, paths):
+        if 'palette' in stages:
+            # palette generation and chunk encoding both read the range
+            self._reset_progress(2 * params.duration)
+        else:
+            self._reset_progress(params.duration)
 
-        if res.returncode != 0:
-            _error('gifsicle returned {}'.format(res.returncode))
+        def merge_done(ret):
+            on_done(0, ret)
 
-        shutil.copy(self._OPTI_GIF_PATH, self._user_gif_path)
-        self._create_gif_window.set_gif_preview(self._OPTI_GIF_PATH)
+        def chunks_done(ret):
+            if ret != 0:
+                on_done(ret, 0)
+                return
+
+            self._optimize_gif(paths, merge_done)
+
+        def palette_done(ret):
+            if ret != 0:
+                on_done(ret, 0)
+                return
+
+            self._parallel_paletteuse(params.start,
+                                      params.start + params.duration,
+                                      params.fps, params.width, paths,
+                                      chunks_done)
+
+        if 'palette' in stages:
+            self._gen_palette(params, palette_done)
+        else:
+            palette_done(0)
+
+    def _start_encode(self):
+        params = self._gif_params
+
+        # long ranges are split into chunks encoded concurrently; half
+        # the CPUs leaves room for the decoders without I/O thrashing
+        n_workers = (os.cpu_count() or 1) // 2
+
+        if 'gif' not in self._stages:
+            self._reset_progress(None)
+            self._optimize_gif(self._raw_gif_paths,
+                               partial(self._encode_done, 0))
+        elif n_workers >= 2 and params.duration >= self._PARALLEL_MIN_TIME:
+            self._new_raw_gif_paths = [self._chunk_gif_path.format(i)
+                                       for i in range(n_workers)]
+            self._encode_gif_parallel(params, self._stages, self._encode_done,
+                                      self._new_raw_gif_paths)
+        else:
+            self._new_raw_gif_paths = [self._gif_path]
+            self._encode_gif(params, self._stages, self._encode_done)
+
+    def _encode_done(self, ffmpeg_ret, gifsicle_ret):
+        # check gifsicle first: when it fails while being fed by
+        # ffmpeg, ffmpeg also fails because of the broken pipe
+        if gifsicle_ret != 0:
+            _error('gifsicle returned {}'.format(gifsicle_ret))
+
+        if ffmpeg_ret != 0 and self._use_vaapi:
+            # the hardware cannot decode or scale this capture: fall
+            # back to the CPU for this run and the following ones
+            self._use_vaapi = False
+            self._start_encode()
+            return
+
+        if ffmpeg_ret != 0:
+            _error('ffmpeg returned {}'.format(ffmpeg_ret))
+
+        params = self._gif_params
+        end = params.start + params.duration
+
+        if 'palette' in self._stages:
+            self._palette_key = (params.start, end, params.fps, params.width)
+
+        if 'gif' in self._stages:
+            self._gif_key = (params.start, end, params.fps, params.width,
+                             self._palette_mtime())
+            self._raw_gif_paths = self._new_raw_gif_paths
+
+        self.progress_changed.emit(100)
+        self._create_gif_window.set_busy(False)
+        self._create_gif_window.set_gif_preview(self._user_gif_path)
+
+    def _create_gif(self):
+        window = self._create_gif_window
+        self._gif_params = _GifParams(start=window.start,
+                                      duration=window.end - window.start,
+                                      fps=window.gif_frame_rate,
+                                      width=window.gif_width,
+                                      colors=window.gif_colors,
+                                      lossy=window.gif_lossy)
+        self._stages = self._pipeline_stages_needed()
+
+        if self._use_vaapi is None:
+            self._use_vaapi = _vaapi_available()
+
+        self._create_gif_window.set_busy(True)
+        self._start_encode()
 
 
 def run():